@@ -114,6 +114,72 @@ class MHESettings(EstimatorSettings):
     """Dictionary with options for the CasADi solver call ``nlpsol`` with plugin ``ipopt``. 
     
     All options are listed `here <http://casadi.sourceforge.net/api/internal/d4/d89/group__nlpsol.html>`_."""
+    jit: bool = False
+    """If ``True``, the CasADi functions for the stage cost (including the cost of the slack variables) and the arrival cost are just-in-time compiled
+    when calling :py:meth:`do_mpc.estimator.MHE.setup`.
+
+    Note:
+        Requires a working C compiler. This only has an effect for models with ``MX`` variables and :py:attr:`expand_nlp` set to ``False``.
+        Otherwise, these functions are inlined in the NLP. To compile the entire NLP, use :py:attr:`jit_backend`.
+    """
+    jit_compiler: str = 'gcc'
+    """C compiler used for just-in-time compilation (see :py:attr:`jit`)."""
+    jit_flags: List[str] = field(default_factory=lambda: ['-O3', '-march=native'])
+    """Flags passed to the C compiler for just-in-time compilation (see :py:attr:`jit`)."""
+    validate_nlp_symbols: bool = True
+    """If ``True``, the objective and the constraints of the optimization problem are evaluated once during :py:meth:`do_mpc.estimator.MHE.setup`
+    to check that they only depend on the optimization variables and parameters.
+
+    Disable this check to reduce the setup time for large problems. Unknown symbolic variables are then only reported by the solver.
+    """
+    linear_solver: str = 'mumps'
+    """Linear solver used by IPOPT (``nlpsol`` option ``ipopt.linear_solver``).
+
+    The default ``'mumps'`` is shipped with CasADi. For medium sized problems the HSL solver ``'MA27'`` is recommended
+    and can drastically boost the speed of do-mpc (requires the HSL library).
+    The option ``ipopt.linear_solver`` in :py:attr:`nlpsol_opts` (e.g. set with :py:meth:`set_linear_solver`) takes precedence.
+    """
+    warm_start: bool = False
+    """If ``True``, IPOPT is warm started from the previous solution (primal variables and multipliers) at each call of :py:meth:`do_mpc.estimator.MHE.make_step`.
+
+    This sets ``ipopt.warm_start_init_point`` together with small bound push and fraction values and the adaptive barrier parameter strategy.
+    Successive MHE problems are typically similar, such that fewer iterations are required. Options in :py:attr:`nlpsol_opts` take precedence.
+    """
+    expand_nlp: bool = True
+    """If ``True``, the NLP is expanded to ``SX`` expressions before the solver is created (``nlpsol`` option ``expand``).
+
+    This is only relevant for models with ``MX`` variables and typically speeds up the function evaluations of the solver.
+    If the expansion fails (e.g. due to external functions), the NLP is created with ``MX`` expressions and a warning is shown.
+    The option ``expand`` in :py:attr:`nlpsol_opts` takes precedence.
+    """
+    jit_backend: str = 'vm'
+    """Choose how the functions of the NLP (objective, constraints and their derivatives) are evaluated by the solver.
+
+    * ``'vm'``: Evaluate with the CasADi virtual machine (default).
+
+    * ``'aot'``: Generate C code and compile it with :py:attr:`jit_compiler` and :py:attr:`jit_flags` when calling :py:meth:`do_mpc.estimator.MHE.setup`.
+
+    Note:
+        Compilation requires a working C compiler and can take a while for large problems.
+        The temporary C files are removed after compilation. Options in :py:attr:`nlpsol_opts` take precedence.
+    """
+    expand: bool = False
+    """If ``True``, the CasADi functions for the stage cost and the arrival cost are expanded to ``SX`` functions.
+
+    This is only relevant for models with ``MX`` variables. The entire NLP is expanded with :py:attr:`expand_nlp`.
+
+    Note:
+        Must be set before calling :py:meth:`do_mpc.estimator.MHE.set_objective`.
+    """
+    n_threads: int = 1
+    """Number of threads to evaluate the time steps along the horizon (discretization, measurements, constraints and stage cost).
+
+    If larger than ``1``, the function for a single time step is mapped over the horizon with CasADi's thread parallelization.
+
+    Note:
+        This only has an effect for models with ``MX`` variables and :py:attr:`expand_nlp` set to ``False``.
+        Otherwise, the mapped function is inlined in the NLP and a warning is shown.
+    """
 
     def check_for_mandatory_settings(self):
         """Method to assert the necessary settings required to design :py:class:`do_mpc.estimator.MHE`
@@ -122,6 +188,8 @@ class MHESettings(EstimatorSettings):
 
         if self.n_horizon is None:
             raise ValueError("n_horizon must be set")
+        if self.jit_backend not in ('vm', 'aot'):
+            raise ValueError("jit_backend must be 'vm' or 'aot'. You have {}".format(self.jit_backend))
     
     def supress_ipopt_output(self):
         """Method to supress the ipopt solver output.
@@ -143,6 +211,8 @@ class MHESettings(EstimatorSettings):
 
             mhe.settings.set_linear_solver(solver_name = "MA27")
 
+        The solver is stored as ``ipopt.linear_solver`` in :py:attr:`nlpsol_opts` and takes precedence over :py:attr:`linear_solver`.
+
         Args:
             solver_name: Specify the solver name.
         """  
@@ -20,20 +20,43 @@
 #   You should have received a copy of the GNU General Public License
 #   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import annotations
 import numpy as np
 #import casadi as cas
 import casadi.tools as castools
-import pdb
-import copy
 import warnings
-import time
 from ..optimizer import Optimizer
 from ._base import Estimator
-import do_mpc
-from typing import Union,Callable
-from dataclasses import asdict
+from typing import Union,Callable,TYPE_CHECKING
+from dataclasses import asdict, fields
 from ._estimatorsettings import MHESettings
 
+if TYPE_CHECKING:
+    import do_mpc
+
+# Valid types for the weighting matrices in MHE.set_default_objective:
+_P_REQUIRED_TYPES = (np.ndarray, castools.SX, castools.MX, castools.DM)
+_P_OPTIONAL_TYPES = _P_REQUIRED_TYPES + (type(None),)
+
+# Names of the settings that can be passed to MHE.set_param:
+_MHE_SETTINGS_FIELDS = frozenset(field.name for field in fields(MHESettings))
+
+
+def _fill_y_buf(y_hist:np.ndarray, y_buf:np.ndarray)->bool:
+    """Private function to write the most recent measurements from ``y_hist`` (one row per measurement)
+    to ``y_buf`` (one row per time step of the horizon). If less measurements than time steps are available, the oldest measurement is repeated.
+
+    Returns:
+        ``False`` if no measurement is available. In this case ``y_buf`` is unchanged.
+    """
+    n_steps = min(y_hist.shape[0], y_buf.shape[0])
+    if n_steps == 0:
+        return False
+    y_buf[-n_steps:] = y_hist[-n_steps:]
+    y_buf[:-n_steps] = y_hist[-n_steps]
+    return True
+
+
 class MHE(Optimizer, Estimator):
     """Moving horizon estimator.
 
@@ -171,53 +194,78 @@ class MHE(Optimizer, Estimator):
         )
 
 
-        # Enable to "unite" _p_est and _p_set to _p
-        p_cat = castools.vertcat(_p)
-        _p_subs = []
-        for name in _p.keys():
-            if name in self._p_est.keys():
-                _p_subs.append(self._p_est[name])
-            elif name in self._p_set.keys():
-                _p_subs.append(self._p_set[name])
-
+        self.n_p_est = self._p_est.shape[0]
+        self.n_p_set = self._p_set.shape[0]
 
+        # Enable to "unite" _p_est and _p_set to _p
+        if self.n_p_est == 0:
+            # All parameters are set (_p_set has the same layout as _p):
+            p_cat = self._p_set.cat
+        elif self.n_p_set == 0:
+            # All parameters are estimated (_p_est has the same layout as _p):
+            p_cat = self._p_est.cat
+        else:
+            p_cat = castools.vertcat(_p)
+            # Every parameter is either in _p_est or in _p_set. Both contain the 'default' entry, where _p_est takes precedence.
+            p_lookup = {}
+            for struct in (self._p_set, self._p_est):
+                p_lookup.update({name: struct[name] for name in struct.keys()})
+            _p_subs = [p_lookup[name] for name in _p.keys()]
 
-        # In the expression p_cat substitute all variables from _p with the elements from _p_est and _p_set:
-        p_cat = castools.substitute(p_cat, _p, castools.vertcat(*_p_subs))
+            # In the expression p_cat substitute all variables from _p with the elements from _p_est and _p_set:
+            p_cat = castools.substitute(p_cat, _p, castools.vertcat(*_p_subs))
 
         # Function to obtain full set of parameters from the seperate structs (while obeying the order):
         self._p_cat_fun = castools.Function('p_cat_fun', [self._p_est, self._p_set], [p_cat])
+        # Column vector of all parameters expressed in _p_est and _p_set:
+        if self.n_p_est == 0 or self.n_p_set == 0:
+            self._p_cat_expr = p_cat
+        else:
+            self._p_cat_expr = self._p_cat_fun(self._p_est, self._p_set)
 
+        # Model parameters ordered as in _p_est and _p_set (used to substitute _p_est and _p_set in the objective):
+        self._p_est_vec = castools.vertcat(*[_p[name] for name in self._p_est.keys()]).reshape((-1,1))
+        self._p_set_vec = castools.vertcat(*[_p[name] for name in self._p_set.keys()]).reshape((-1,1))
 
-        self.n_p_est = self._p_est.shape[0]
-        self.n_p_set = self._p_set.shape[0]
-
-        # Initialize additional structures by calling the symbolic structures defined above
-        # with the default numerical value.
-        # This returns an identical numerical structure with all values set to the passed value.
+        # Additional numerical structures for the parameters are created on first access (see properties below).
         # TODO: p_scaling already exists. Maybe use it instead of these seperate structs?
-        self._p_est_scaling = self._p_est(1.0)
-        self._p_set_scaling = self._p_set(1.0) # This not meant to be adapted. We need it to concatenate p_scaling.
+        self.__p_est_scaling = None
+        self.__p_set_scaling = None
+        self.__p_est_lb = None
+        self.__p_est_ub = None
+        self.__p_est0 = None
 
-        self._p_est_lb = self._p_est(-np.inf)
-        self._p_est_ub = self._p_est(np.inf)
-
-        self._p_est0 = self._p_est(0.0)
+        # Labels of the templates to check the output of p_fun and y_fun (y_template labels are cached per horizon):
+        self._p_template_labels = self._p_set(0).labels()
+        self._y_template_labels = {}
 
 
         # Introduce aliases / new variables to smoothly and intuitively formulate
         # the MHE objective function.
         self._y_meas = self.model._y
 
-        self._x_prev = copy.copy(self.model._x)
+        # Previous states and parameters have the same layout but new symbolic variables:
+        self._x_prev = self.model.sv.sym_struct(
+            [castools.entry(name, shape=self.model._x[name].shape) for name in self.model._x.keys()]
+        )
         self._x = self.model._x
 
-        self._p_est_prev = copy.copy(self._p_est)
+        self._p_est_prev = self.model.sv.sym_struct(
+            [castools.entry(name, shape=self._p_est[name].shape) for name in self._p_est.keys()]
+        )
         self._p = self.model._p
 
         self._w = self.model._w
         self._v = self.model._v
 
+        # Concatenated vectors of the variables above (used in set_default_objective):
+        self._w_cat = self._w.cat
+        self._v_cat = self._v.cat
+        self._x_cat = self._x.cat
+        self._x_prev_cat = self._x_prev.cat
+        self._p_est_cat = self._p_est.cat
+        self._p_est_prev_cat = self._p_est_prev.cat
+
         # Flags are checked when calling .setup.
         self.flags.update({
             'setup': False,
@@ -228,6 +276,47 @@ class MHE(Optimizer, Estimator):
             'set_initial_guess': False,
         })
 
+    # The following structures are created by calling the symbolic structures defined in __init__
+    # with the default numerical value. This returns an identical numerical structure with all values set to the passed value.
+    @property
+    def _p_est_scaling(self):
+        """Scaling of the estimated parameters."""
+        if self.__p_est_scaling is None:
+            self.__p_est_scaling = self._p_est(1.0)
+        return self.__p_est_scaling
+
+    @property
+    def _p_set_scaling(self):
+        """Scaling of the set parameters. This not meant to be adapted. We need it to concatenate p_scaling."""
+        if self.__p_set_scaling is None:
+            self.__p_set_scaling = self._p_set(1.0)
+        return self.__p_set_scaling
+
+    @property
+    def _p_est_lb(self):
+        """Lower bounds of the estimated parameters."""
+        if self.__p_est_lb is None:
+            self.__p_est_lb = self._p_est(-np.inf)
+        return self.__p_est_lb
+
+    @property
+    def _p_est_ub(self):
+        """Upper bounds of the estimated parameters."""
+        if self.__p_est_ub is None:
+            self.__p_est_ub = self._p_est(np.inf)
+        return self.__p_est_ub
+
+    @property
+    def _p_est0(self):
+        """Numerical structure of the estimated parameters. See :py:attr:`p_est0`."""
+        if self.__p_est0 is None:
+            self.__p_est0 = self._p_est(0.0)
+        return self.__p_est0
+
+    @_p_est0.setter
+    def _p_est0(self, val):
+        self.__p_est0 = val
+
     @property
     def p_est0(self):
         """ Initial value of estimated parameters and current iterate.
@@ -262,7 +351,11 @@ class MHE(Optimizer, Estimator):
 
     @p_est0.setter
     def p_est0(self, val):
-        self._p_est0 = self._convert2struct(val, self._p_est)
+        if isinstance(val, (np.ndarray, castools.DM)) and val.shape[0] == self.n_p_est and np.prod(val.shape) == self.n_p_est:
+            # Vector of matching size: Update the existing structure in place (as in make_step).
+            self._p_est0.master = castools.DM(val)
+        else:
+            self._p_est0 = self._convert2struct(val, self._p_est)
 
 
     @property
@@ -477,12 +570,48 @@ class MHE(Optimizer, Estimator):
         assert self.flags['setup'] == False, 'Setting parameters after setup is prohibited.'
 
         for key, value in kwargs.items():
-            if hasattr(self.settings, key):
+            if key in _MHE_SETTINGS_FIELDS:
                     setattr(self.settings, key, value)
             else:
                 print('Warning: Key {} does not exist for MPC.'.format(key))
 
 
+    def _get_function_opts(self)->dict:
+        """Private method that returns the options for the CasADi functions of the stage and arrival cost in the NLP.
+        The options enable just-in-time compilation if :py:attr:`MHESettings.jit` is set
+        and the functions are not inlined in an expanded NLP (see :py:attr:`MHESettings.expand_nlp`).
+        """
+        if not self.settings.jit or self._is_nlp_expanded():
+            return {}
+
+        return self._get_jit_opts()
+
+    def _is_nlp_expanded(self)->bool:
+        """Private method that returns ``True`` if the functions called in the NLP are inlined in ``SX`` expressions.
+        This is the case for models with ``SX`` variables and if the NLP is expanded (see :py:attr:`MHESettings.expand_nlp`).
+        """
+        expand_nlp = self.settings.nlpsol_opts.get('expand', self.settings.expand_nlp)
+        return self.model.symvar_type == 'SX' or expand_nlp
+
+    def _get_jit_opts(self)->dict:
+        """Private method that returns the CasADi options for just-in-time compilation
+        with the compiler and flags from :py:attr:`MHESettings.jit_compiler` and :py:attr:`MHESettings.jit_flags`.
+        """
+        return {
+            'jit': True,
+            'compiler': 'shell',
+            'jit_options': {'compiler': self.settings.jit_compiler, 'flags': self.settings.jit_flags, 'verbose': False},
+        }
+
+    def _create_cost_function(self, name:str, inputs:list, outputs:list)->castools.Function:
+        """Private method to create the CasADi function for the stage and arrival cost.
+        The function is expanded to an ``SX`` function if :py:attr:`MHESettings.expand` is set.
+        """
+        if self.settings.expand:
+            return castools.Function(name, inputs, outputs).expand(name)
+
+        return castools.Function(name, inputs, outputs)
+
     def set_objective(self, stage_cost:Union[castools.SX,castools.MX], arrival_cost:Union[castools.SX,castools.MX])->None:
         """Set the stage cost :math:`l(\cdot)` and arrival cost :math:`m(\cdot)` function for the MHE problem:
 
@@ -563,23 +692,17 @@ class MHE(Optimizer, Estimator):
         assert self.flags['setup'] == False, 'Cannot call .set_objective after .setup.'
 
         # Replace model symbolic variables self.model._p with the new variables self._p_est and self._p_set:
-        _p = self._p_cat_fun(self._p_est, self._p_set)
-
-        arrival_cost = castools.substitute(arrival_cost, self.model._p, _p.reshape((-1,1)))
-        #stage_cost = substitute(stage_cost, self.model._p, _p)
-
-        #arrival_cost = substitute(arrival_cost, self._p_est, vertcat(*[self.model._p[name] for name in self._p_est.keys()]))
-        #arrival_cost = substitute(arrival_cost, self._p_set, vertcat(*[self.model._p[name] for name in self._p_set.keys()]))
+        arrival_cost = castools.substitute(arrival_cost, self.model._p, self._p_cat_expr)
 
-        stage_cost = castools.substitute(stage_cost, self._p_est, castools.vertcat(*[self.model._p[name] for name in self._p_est.keys()]).reshape((-1,1)))
-        stage_cost = castools.substitute(stage_cost, self._p_set, castools.vertcat(*[self.model._p[name] for name in self._p_set.keys()]).reshape((-1,1)))
+        # Substitute _p_est and _p_set jointly (single traversal of the expression graph):
+        stage_cost = castools.substitute([stage_cost], [self._p_est_cat, self._p_set.cat], [self._p_est_vec, self._p_set_vec])[0]
 
 
         stage_cost_input = self._w, self._v, self.model._tvp, self.model._p
-        self.stage_cost_fun = castools.Function('stage_cost_fun', [*stage_cost_input], [stage_cost])
+        self.stage_cost_fun = self._create_cost_function('stage_cost_fun', [*stage_cost_input], [stage_cost])
 
         arrival_cost_input = self._x, self._x_prev, self._p_est, self._p_est_prev, self._p_set
-        self.arrival_cost_fun = castools.Function('arrival_cost_fun', [*arrival_cost_input], [arrival_cost])
+        self.arrival_cost_fun = self._create_cost_function('arrival_cost_fun', [*arrival_cost_input], [arrival_cost])
 
         # Check if stage_cost_fun and arrival_cost_fun use invalid variables as inputs.
         # For the check we evaluate the function with dummy inputs and expect a DM output.
@@ -658,59 +781,70 @@ class MHE(Optimizer, Estimator):
             P_p: Tuning matrix :math:`P_p` of dimension :math:`l \\times l` :math:`(p_{\\text{est}} \\in \\mathbb{R}^{l})`)
             P_w: Tuning matrix :math:`P_w` of dimension :math:`k \\times k` :math:`(w \\in \\mathbb{R}^{k})`
         """
-        input_types = (np.ndarray, castools.SX, castools.MX, castools.DM)
-        err_msg = '{name} must be of type {type_set}, you have {type_is}'
-        assert isinstance(P_x, input_types), err_msg.format(name='P_x', type_set = input_types, type_is = type(P_x))
-        input_types = (np.ndarray, castools.SX, castools.MX, castools.DM, type(None))
-        assert isinstance(P_v, input_types), err_msg.format(name='P_v', type_set = input_types, type_is = type(P_v))
-        assert isinstance(P_p, input_types), err_msg.format(name='P_p', type_set = input_types, type_is = type(P_p))
-        assert isinstance(P_w, input_types), err_msg.format(name='P_w', type_set = input_types, type_is = type(P_w))
-
         n_x = self.model.n_x
         n_y = self.model.n_y
         n_w = self.model.n_w
         n_v = self.model.n_v
         n_p = self.n_p_est
-        assert P_x.shape == (n_x, n_x), 'P_x has wrong shape:{}, must be {}'.format(P_x.shape, (n_x,n_x))
+        if __debug__:
+            # Skipped (like assertions) when running python with -O.
+            self._validate_weights(P_x, P_v, P_p, P_w, (n_x, n_v, n_p, n_w))
 
+        # Both cost terms are a single quadratic form of the stacked variables with a block-diagonal weighting matrix.
         # Calculate stage cost:
-        stage_cost = castools.DM(0)
+        stage_vars = []
+        stage_weights = []
 
         if P_v is None:
             assert n_v == 0, 'Must pass weighting factor P_v, since you have measurement noise on some measurements (configured in model).'
         else:
-            assert P_v.shape == (n_v, n_v), 'P_v has wrong shape:{}, must be {}'.format(P_v.shape, (n_v,n_v))
-            v = self._v.cat
-            stage_cost += v.T@P_v@v
-
+            stage_vars.append(self._v_cat)
+            stage_weights.append(P_v)
 
         if P_w is None:
             assert n_w == 0, 'Must pass weighting factor P_w, since you have process noise on some states (configured in model).'
         else:
-            assert P_w.shape == (n_w, n_w), 'P_w has wrong shape:{}, must be {}'.format(P_w.shape, (n_w,n_w))
-            w = self._w.cat
-            stage_cost += w.T@P_w@w
+            stage_vars.append(self._w_cat)
+            stage_weights.append(P_w)
 
-        # Calculate arrival cost:
-        x_0 = self._x
-        x_prev = self._x_prev
-        dx = x_0.cat - x_prev.cat
+        if stage_vars:
+            vw = castools.vertcat(*stage_vars)
+            stage_cost = vw.T@castools.diagcat(*stage_weights)@vw
+        else:
+            stage_cost = castools.DM(0)
 
-        arrival_cost = dx.T@P_x@dx
+        # Calculate arrival cost:
+        arrival_vars = [self._x_cat - self._x_prev_cat]
+        arrival_weights = [P_x]
 
         # Add parameter term if there are parameters to be estimated:
         if P_p is None:
             assert n_p == 0, 'Must pass weighting factor P_p, since you are trying to estimate parameters.'
         else:
-            assert P_p.shape == (n_p, n_p), 'P_p has wrong shape:{}, must be {}'.format(P_p.shape, (n_p,n_p))
-            p_0 = self._p_est
-            p_prev = self._p_est_prev
-            dp = p_0.cat - p_prev.cat
-            arrival_cost += dp.T@P_p@dp
+            arrival_vars.append(self._p_est_cat - self._p_est_prev_cat)
+            arrival_weights.append(P_p)
+
+        dxp = castools.vertcat(*arrival_vars)
+        arrival_cost = dxp.T@castools.diagcat(*arrival_weights)@dxp
 
         # Set MHE objective:
         self.set_objective(stage_cost, arrival_cost)
 
+    @staticmethod
+    def _validate_weights(P_x, P_v, P_p, P_w, dims:tuple)->None:
+        """Private method to check the types and shapes of the weighting matrices passed to :py:func:`set_default_objective`.
+        Only ``P_x`` is required. The shapes of weighting matrices that are ``None`` are not checked.
+
+        Args:
+            dims: Dimensions ``(n_x, n_v, n_p, n_w)`` of the weighted variables.
+        """
+        names = ('P_x', 'P_v', 'P_p', 'P_w')
+        input_types = (_P_REQUIRED_TYPES, _P_OPTIONAL_TYPES, _P_OPTIONAL_TYPES, _P_OPTIONAL_TYPES)
+        for name, P, type_set, n in zip(names, (P_x, P_v, P_p, P_w), input_types, dims):
+            assert isinstance(P, type_set), '{} must be of type {}, you have {}'.format(name, type_set, type(P))
+            shape = getattr(P, 'shape', None)
+            assert shape is None or shape == (n, n), '{} has wrong shape:{}, must be {}'.format(name, shape, (n, n))
+
     def get_p_template(self)->Union[castools.structure3.SXStruct,castools.structure3.MXStruct]:
         """Obtain output template for :py:func:`set_p_fun`.
         This is used to set the (not estimated) parameters.
@@ -735,7 +869,7 @@ class MHE(Optimizer, Estimator):
         Args:
             p_fun: Parameter function.
         """
-        assert self.get_p_template().labels() == p_fun(0).labels(), 'Incorrect output of p_fun. Use get_p_template to obtain the required structure.'
+        assert self._p_template_labels == p_fun(0).labels(), 'Incorrect output of p_fun. Use get_p_template to obtain the required structure.'
         self.p_fun = p_fun
         self.flags['set_p_fun'] = True
 
@@ -763,19 +897,19 @@ class MHE(Optimizer, Estimator):
         ::
 
             y_template = self.get_y_template()
+            y_buf = np.zeros((self.settings.n_horizon, self.model.n_y))
 
             def y_fun(t_now):
-                n_steps = min(self.data._y.shape[0], self.n_horizon)
-                for k in range(-n_steps,0):
-                    y_template['y_meas',k] = self.data._y[k]
-                try:
-                    for k in range(self.n_horizon-n_steps):
-                        y_template['y_meas',k] = self.data._y[-n_steps]
-                except:
-                    None
+                n_steps = min(self.data._y.shape[0], self.settings.n_horizon)
+                if n_steps > 0:
+                    y_buf[-n_steps:] = self.data._y[-n_steps:]
+                    # Repeat the oldest measurement if less than n_horizon measurements are available:
+                    y_buf[:-n_steps] = self.data._y[-n_steps]
+                    y_template.master = castools.DM(y_buf.ravel())
                 return y_template
 
         Which simply reads the last results from the ``MHE.data`` object.
+        The measurements are written to the structure at once from a buffer with one row per time step.
 
         Returns:
             y_template
@@ -792,10 +926,19 @@ class MHE(Optimizer, Estimator):
         Args:
             y_fun: measurement function.
         """
-        assert self.get_y_template().labels() == y_fun(0).labels(), 'Incorrect output of y_fun. Use get_y_template to obtain the required structure.'
+        assert self._get_y_template_labels() == y_fun(0).labels(), 'Incorrect output of y_fun. Use get_y_template to obtain the required structure.'
         self.y_fun = y_fun
         self.flags['set_y_fun'] = True
 
+    def _get_y_template_labels(self)->list:
+        """Private method that returns the labels of the structure obtained with :py:func:`get_y_template`.
+        The labels are cached for the current horizon.
+        """
+        n_horizon = self.settings.n_horizon
+        if n_horizon not in self._y_template_labels:
+            self._y_template_labels[n_horizon] = self.get_y_template().labels()
+        return self._y_template_labels[n_horizon]
+
 
     def _check_validity(self)->None:
         """Private method to be called in :py:func:`setup`. Checks if the configuration is valid and
@@ -839,16 +982,12 @@ class MHE(Optimizer, Estimator):
         if self.flags['set_y_fun'] == False and self.settings.meas_from_data:
             # Case that measurement function is automatically created.
             y_template = self.get_y_template()
+            # Buffer with one row per time step (same order as y_template.master):
+            self._y_buf = np.zeros((self.settings.n_horizon, self.model.n_y))
 
             def y_fun(t_now):
-                n_steps = min(self.data._y.shape[0], self.settings.n_horizon)
-                for k in range(-n_steps,0):
-                    y_template['y_meas',k] = self.data._y[k]
-                try:
-                    for k in range(self.settings.n_horizon-n_steps):
-                        y_template['y_meas',k] = self.data._y[-n_steps]
-                except:
-                    None
+                if _fill_y_buf(self.data._y, self._y_buf):
+                    y_template.master = castools.DM(self._y_buf.ravel())
                 return y_template
             self.set_y_fun(y_fun)
         elif self.flags['set_y_fun'] == True:
@@ -923,8 +1062,7 @@ class MHE(Optimizer, Estimator):
         assert n_val == self.model.n_y, 'Wrong input with shape {}. Expected vector with {} elements'.format(n_val, self.model.n_y)
         # Check (once) if the initial guess was supplied.
         if not self.flags['set_initial_guess']:
-            warnings.warn('Intial guess for the optimizer was not set. The solver call is likely to fail.')
-            time.sleep(5)
+            warnings.warn('Intial guess for the optimizer was not set. The solver call is likely to fail.', stacklevel=2)
             # Since do-mpc is warmstarting, the initial guess will exist after the first call.
             self.flags['set_initial_guess'] = True
 
@@ -939,7 +1077,7 @@ class MHE(Optimizer, Estimator):
 
         y_traj = self.y_fun(t0)
 
-        self.opt_p_num['_x_prev'] = self.opt_x_num['_x', 1, -1]*self._x_scaling
+        self.opt_p_num.master[self._x_prev_opt_p_ind] = self.opt_x_num.master[self._x_prev_opt_x_ind]*self._x_scaling.cat
         self.opt_p_num['_p_est_prev'] = p_est0
         self.opt_p_num['_p_set'] = p_set0
         self.opt_p_num['_tvp'] = tvp0['_tvp']
@@ -947,12 +1085,13 @@ class MHE(Optimizer, Estimator):
 
         self.solve()
 
-        # Extract solution:
-        x_next = self.opt_x_num['_x', -1, -1]*self._x_scaling
-        p_est_next = self.opt_x_num['_p_est']*self._p_est_scaling
-        u0 = self.opt_x_num['_u', -1]*self._u_scaling
+        # Extract solution (solve already computed the unscaled solution):
+        opt_x_num_unscaled = self.opt_x_num_unscaled
+        x_next = opt_x_num_unscaled['_x', -1, -1]
+        p_est_next = opt_x_num_unscaled['_p_est']
+        u0 = opt_x_num_unscaled['_u', -1]
         # Which z must be extracted here?
-        z0  = self.opt_x_num['_z', -1, -1]*self._z_scaling
+        z0  = opt_x_num_unscaled['_z', -1, -1]
         aux0 = self.opt_aux_num['_aux', -1]
         p0 = self._p_cat_fun(p_est0, p_set0)
 
@@ -968,7 +1107,6 @@ class MHE(Optimizer, Estimator):
         # Store additional information
         self.data.update(opt_p_num = self.opt_p_num)
         if self.settings.store_full_solution == True:
-            opt_x_num_unscaled = self.opt_x_num_unscaled
             opt_aux_num = self.opt_aux_num
             self.data.update(_opt_x_num = opt_x_num_unscaled)
             self.data.update(_opt_aux_num = opt_aux_num)
@@ -993,36 +1131,36 @@ class MHE(Optimizer, Estimator):
         """Private method to update the bounds of the optimization variables based on the current values defined with :py:attr:`scaling`.
 
         Note:
-            Bounds are automatically scaled as they invoke the :py:attr:lb_opt_x` and :py:attr:`ub_opt_x` methods. Scaling is done automatically in these methods.
+            Bounds are scaled with :py:attr:`opt_x_scaling` (as when setting :py:attr:`lb_opt_x` and :py:attr:`ub_opt_x`).
         """
-        if self.settings.cons_check_colloc_points:   # Constraints for all collocation points.
-            # Bounds for the states on all discretize values along the horizon
-            self.lb_opt_x['_x'] = self._x_lb.cat
-            self.ub_opt_x['_x'] = self._x_ub.cat
-
-            # Bounds for the algebraic states along the horizon
-            self.lb_opt_x['_z'] = self._z_lb.cat
-            self.ub_opt_x['_z'] = self._z_ub.cat
-        else:   # Constraints only at the beginning of the finite Element
-            # Bounds for the states on all discretize values along the horizon
-            self.lb_opt_x['_x', 1:self.settings.n_horizon, -1] = self._x_lb.cat
-            self.ub_opt_x['_x', 1:self.settings.n_horizon, -1] = self._x_ub.cat
+        lb_opt_x = self._lb_opt_x.master.full().ravel()
+        ub_opt_x = self._ub_opt_x.master.full().ravel()
+        self._fill_bounds(lb_opt_x, ub_opt_x)
 
-            # Bounds for the algebraic states along the horizon
-            self.lb_opt_x['_z', :, 0] = self._z_lb.cat
-            self.ub_opt_x['_z', :, 0] = self._z_ub.cat
+        self._lb_opt_x.master = castools.DM(lb_opt_x)
+        self._ub_opt_x.master = castools.DM(ub_opt_x)
 
-        # Bounds for the inputs along the horizon
-        self.lb_opt_x['_u'] = self._u_lb.cat
-        self.ub_opt_x['_u'] = self._u_ub.cat
-
-        # Bounds for the slack variables along the horizon:
-        self.lb_opt_x['_eps'] = self._eps_lb.cat
-        self.ub_opt_x['_eps'] = self._eps_ub.cat
-
-        # Bounds for the inputs along the horizon
-        self.lb_opt_x['_p_est'] = self._p_est_lb.cat
-        self.ub_opt_x['_p_est'] = self._p_est_ub.cat
+    def _fill_bounds(self, lb_opt_x:np.ndarray, ub_opt_x:np.ndarray)->None:
+        """Private method to write the (scaled) bounds of the optimization variables to the flat arrays ``lb_opt_x`` and ``ub_opt_x`` (in place).
+        Elements without bounds (e.g. ``_w`` and ``_v``) are not modified.
+        """
+        scaling = self.opt_x_scaling.master.full().ravel()
+
+        bounds = {
+            '_x': (self._x_lb, self._x_ub),
+            '_z': (self._z_lb, self._z_ub),
+            '_u': (self._u_lb, self._u_ub),
+            '_eps': (self._eps_lb, self._eps_ub),
+            '_p_est': (self._p_est_lb, self._p_est_ub),
+        }
+        for var_type, (lb, ub) in bounds.items():
+            # Flat indices of all bounded elements of var_type in opt_x (repeated along the horizon):
+            cind = self._opt_x_bounds_ind[var_type]
+            if cind.size == 0:
+                continue
+            n_repeat = cind.size//lb.size
+            lb_opt_x[cind] = np.tile(lb.cat.full().ravel(), n_repeat)/scaling[cind]
+            ub_opt_x[cind] = np.tile(ub.cat.full().ravel(), n_repeat)/scaling[cind]
 
     def _prepare_nlp(self):
         """Internal method. See detailed documentation in optimizer.prepare_nlp
@@ -1033,6 +1171,10 @@ class MHE(Optimizer, Estimator):
         self._setup_nl_cons(nl_cons_input)
         self._check_validity()
 
+        # Recreate the parameter concatenation function as expanded SX function,
+        # as it is evaluated numerically at every call of make_step.
+        self._p_cat_fun = castools.Function('p_cat_fun', [self._p_est, self._p_set], [self._p_cat_expr]).expand('p_cat_fun')
+
         # Concatenate _p_est_scaling und _p_set_scaling to p_scaling (and make it a struct again)
         self._p_scaling = self.model._p(self._p_cat_fun(self._p_est_scaling, self._p_set_scaling))
 
@@ -1081,6 +1223,10 @@ class MHE(Optimizer, Estimator):
         ])
         self.n_opt_p = opt_p.shape[0]
 
+        # Flat indices to pass the (unscaled) second state of the previous solution as _x_prev in make_step:
+        self._x_prev_opt_x_ind = opt_x.f['_x', 1, -1]
+        self._x_prev_opt_p_ind = opt_p.f['_x_prev']
+
         # Dummy struct with symbolic variables
         self.aux_struct = self.model.sv.sym_struct([
             castools.entry('_aux', repeat=[self.settings.n_horizon], struct=self.model._aux_expression)
@@ -1090,8 +1236,27 @@ class MHE(Optimizer, Estimator):
 
         self.n_opt_aux = opt_aux.shape[0]
 
-        self._lb_opt_x = opt_x(-np.inf)
-        self._ub_opt_x = opt_x(np.inf)
+        # Flat indices of the bounded variables in opt_x (see _fill_bounds):
+        if self.settings.cons_check_colloc_points:   # Constraints for all collocation points.
+            x_bounds_ind = opt_x.f['_x']
+            z_bounds_ind = opt_x.f['_z']
+        else:   # Constraints only at the beginning of the finite Element
+            x_bounds_ind = opt_x.f['_x', 1:self.settings.n_horizon, -1]
+            z_bounds_ind = opt_x.f['_z', :, 0]
+        self._opt_x_bounds_ind = {
+            '_x': np.array(x_bounds_ind, dtype=int),
+            '_z': np.array(z_bounds_ind, dtype=int),
+            '_u': np.array(opt_x.f['_u'], dtype=int),
+            '_eps': np.array(opt_x.f['_eps'], dtype=int),
+            '_p_est': np.array(opt_x.f['_p_est'], dtype=int),
+        }
+
+        # Create the bounds from flat arrays (see _update_bounds):
+        lb_opt_x = np.full(self.n_opt_x, -np.inf)
+        ub_opt_x = np.full(self.n_opt_x, np.inf)
+        self._fill_bounds(lb_opt_x, ub_opt_x)
+        self._lb_opt_x = opt_x(castools.DM(lb_opt_x))
+        self._ub_opt_x = opt_x(castools.DM(ub_opt_x))
 
         # Initialize objective function and constraints
         obj = castools.DM(0)
@@ -1100,7 +1265,10 @@ class MHE(Optimizer, Estimator):
         cons_ub = []
 
         # Arrival cost:
-        arrival_cost = self.arrival_cost_fun(
+        arrival_cost_fun = self.arrival_cost_fun
+        if self._get_function_opts():
+            arrival_cost_fun = arrival_cost_fun.wrap_as_needed(self._get_function_opts())
+        arrival_cost = arrival_cost_fun(
             opt_x_unscaled['_x', 0, -1],
             opt_p['_x_prev'],#/self._x_scaling,
             opt_x_unscaled['_p_est'],
@@ -1113,75 +1281,120 @@ class MHE(Optimizer, Estimator):
         # Get concatenated parameters vector containing the estimated and fixed parameters (scaled)
         _p = self._p_cat_fun(opt_x['_p_est'], opt_p['_p_set']/self._p_set_scaling)
 
-        # For all control intervals
-        for k in range(self.settings.n_horizon):
-            # Compute constraints and predicted next state of the discretization scheme
-            col_xk = castools.vertcat(*opt_x['_x', k+1, :-1])
-            col_zk = castools.vertcat(*opt_x['_z', k])
-            [g_ksb, xf_ksb] = ifcn(opt_x['_x', k, -1], col_xk,
-                                   opt_x['_u', k], col_zk, opt_p['_tvp', k],
-                                   _p, opt_x['_w', k])
-
-            # Compute current measurement
-            # Note, when using an algebraic variable `z` in the measurement function,
-            # this is only exact for the Radau collocation scheme,
-            # because the Radau scheme has a collocation point at the end of the interval.
-            # For other schemes, this is only an approximation,
-            # because the algebraic variable is not defined at the end of the interval but only close to it.
-            yk_calc = self.model._meas_fun(opt_x_unscaled['_x', k+1, -1], opt_x_unscaled['_u', k], opt_x_unscaled['_z', k, -1],
-                opt_p['_tvp', k], _p, opt_x_unscaled['_v', k])
-
-            # Add the collocation equations
-            cons.append(g_ksb)
-            cons_lb.append(np.zeros(g_ksb.shape[0]))
-            cons_ub.append(np.zeros(g_ksb.shape[0]))
-
-            # Add continuity constraints
-            cons.append(xf_ksb - opt_x['_x', k+1, -1])
-            cons_lb.append(np.zeros((self.model.n_x, 1)))
-            cons_ub.append(np.zeros((self.model.n_x, 1)))
-
-            # Add measurement constraints
-            cons.append(yk_calc - opt_p['_y_meas', k])
-            cons_lb.append(np.zeros((self.model.n_y, 1)))
-            cons_ub.append(np.zeros((self.model.n_y, 1)))
-
-            k_eps = min(k, n_eps-1)
-            if self.settings.nl_cons_check_colloc_points:
-                # Ensure nonlinear constraints on all collocation points
-                for i in range(n_total_coll_points):
-                    nl_cons_k = self._nl_cons_fun(
-                        opt_x_unscaled['_x', k+1, i], opt_x_unscaled['_u', k], opt_x_unscaled['_z', k, i],
-                        opt_p['_tvp', k], opt_x['_p_est'], opt_p['_p_set'], opt_x_unscaled['_eps', k_eps])
-                    cons.append(nl_cons_k)
-                    cons_lb.append(self._nl_cons_lb)
-                    cons_ub.append(self._nl_cons_ub)
-            else:
-                # Ensure nonlinear constraints only on the beginning of the FE
-                nl_cons_k = self._nl_cons_fun(
-                    opt_x_unscaled['_x', k, -1], opt_x_unscaled['_u', k], opt_x_unscaled['_z', k, 0],
-                    opt_p['_tvp', k], opt_x['_p_est'], opt_p['_p_set'], opt_x_unscaled['_eps', k_eps])
-                cons.append(nl_cons_k)
-                cons_lb.append(self._nl_cons_lb)
-                cons_ub.append(self._nl_cons_ub)
-
-            cons.append(nl_cons_k)
-            cons_lb.append(self._nl_cons_lb)
-            cons_ub.append(self._nl_cons_ub)
-
-            obj += self.stage_cost_fun(
-                opt_x_unscaled['_w', k], opt_x_unscaled['_v', k], opt_p['_tvp', k], _p
-            )
+        # Create a function for a single time step of the horizon and evaluate it for all time steps at once.
+        n_horizon = self.settings.n_horizon
+        n_x = self.model.n_x
+        n_z = self.model.n_z
+        n_z_points = max(n_total_coll_points, 1)
+
+        # Inputs of the time step k (scaled variables as in opt_x):
+        sym = self.model.sv.sym
+        x_k = sym('x_k', n_x)                               # opt_x['_x', k, -1]
+        x_col = sym('x_col', n_x*n_total_coll_points)       # opt_x['_x', k+1, :-1]
+        x_next = sym('x_next', n_x)                         # opt_x['_x', k+1, -1]
+        u_k = sym('u_k', self.model.n_u)
+        z_col = sym('z_col', n_z*n_z_points)                # opt_x['_z', k]
+        w_k = sym('w_k', self.model.n_w)
+        v_k = sym('v_k', self.model.n_v)
+        eps_k = sym('eps_k', self.n_eps)
+        tvp_k = sym('tvp_k', self.model.n_tvp)
+        y_meas_k = sym('y_meas_k', self.model.n_y)
+        # Inputs that are identical for all time steps:
+        p = sym('p', self.model.n_p)
+        p_est = sym('p_est', self.n_p_est)
+        p_set = sym('p_set', self.n_p_set)
+
+        # Unscaled (physical) variables. _w, _v and _eps are not scaled.
+        x_k_unscaled = x_k*self._x_scaling.cat
+        x_col_unscaled = x_col*castools.repmat(self._x_scaling.cat, n_total_coll_points, 1)
+        x_next_unscaled = x_next*self._x_scaling.cat
+        u_k_unscaled = u_k*self._u_scaling.cat
+        z_col_unscaled = z_col*castools.repmat(self._z_scaling.cat, n_z_points, 1)
+        z_k_unscaled = castools.vertsplit(z_col_unscaled, n_z) if n_z > 0 else [z_col_unscaled]*n_z_points
+
+        # Compute constraints and predicted next state of the discretization scheme
+        [g_ksb, xf_ksb] = ifcn(x_k, x_col, u_k, z_col, tvp_k, p, w_k)
+
+        # Compute current measurement
+        # Note, when using an algebraic variable `z` in the measurement function,
+        # this is only exact for the Radau collocation scheme,
+        # because the Radau scheme has a collocation point at the end of the interval.
+        # For other schemes, this is only an approximation,
+        # because the algebraic variable is not defined at the end of the interval but only close to it.
+        yk_calc = self.model._meas_fun(x_next_unscaled, u_k_unscaled, z_k_unscaled[-1], tvp_k, p, v_k)
+
+        if self.settings.nl_cons_check_colloc_points and n_total_coll_points > 0:
+            # Ensure nonlinear constraints on all collocation points
+            x_k_nl_cons = castools.vertsplit(x_col_unscaled, n_x) if n_x > 0 else [x_col_unscaled]*n_total_coll_points
+            z_k_nl_cons = z_k_unscaled[:n_total_coll_points]
+        else:
+            # Ensure nonlinear constraints only on the beginning of the FE
+            x_k_nl_cons = [x_k_unscaled]
+            z_k_nl_cons = z_k_unscaled[:1]
+        nl_cons_k = [
+            self._nl_cons_fun(x_i, u_k_unscaled, z_i, tvp_k, p_est, p_set, eps_k)
+            for x_i, z_i in zip(x_k_nl_cons, z_k_nl_cons)
+        ]
+
+        # Stage cost and cost of the slack variables in a single function:
+        stage_eps_cost_fun = castools.Function('stage_eps_cost', [w_k, v_k, eps_k, tvp_k, p],
+            [self.stage_cost_fun(w_k, v_k, tvp_k, p) + self.epsterm_fun(eps_k)]
+        )
+        try:
+            stage_eps_cost_fun = stage_eps_cost_fun.expand('stage_eps_cost', self._get_function_opts())
+        except RuntimeError:
+            # Not all MX expressions (e.g. external functions) can be expanded to SX.
+            pass
 
-            # Add slack variables to the cost
-            obj += self.epsterm_fun(opt_x_unscaled['_eps', k_eps])
+        step_fun = castools.Function('mhe_step',
+            [x_k, x_col, x_next, u_k, z_col, w_k, v_k, eps_k, tvp_k, y_meas_k, p, p_est, p_set],
+            [
+                g_ksb,
+                # Continuity constraints
+                xf_ksb - x_next,
+                # Measurement constraints
+                yk_calc - y_meas_k,
+                castools.vertcat(*nl_cons_k),
+                stage_eps_cost_fun(w_k, v_k, eps_k, tvp_k, p),
+                # Auxiliary expressions
+                self.model._aux_expression_fun(x_k_unscaled, u_k_unscaled, z_k_unscaled[-1], tvp_k, p),
+            ]
+        )
+        if self.settings.n_threads > 1:
+            if self._is_nlp_expanded():
+                warnings.warn('n_threads has no effect for models with SX variables or with expand_nlp set to True. The time steps are evaluated sequentially.')
+            step_fun = step_fun.map(n_horizon, 'thread', self.settings.n_threads)
+        else:
+            step_fun = step_fun.map(n_horizon)
+
+        # With a single slack variable for the horizon, the same eps is used for all time steps (broadcasted by map).
+        g, cont, meas, nl_cons, stage_eps_cost, aux = step_fun(
+            castools.horzcat(*opt_x['_x', :-1, -1]),
+            castools.horzcat(*[castools.vertcat(*x_col_k) for x_col_k in opt_x['_x', 1:, :-1]]),
+            castools.horzcat(*opt_x['_x', 1:, -1]),
+            castools.horzcat(*opt_x['_u', :]),
+            castools.horzcat(*[castools.vertcat(*z_col_k) for z_col_k in opt_x['_z', :, :]]),
+            castools.horzcat(*opt_x['_w', :]),
+            castools.horzcat(*opt_x['_v', :]),
+            castools.horzcat(*opt_x['_eps', :]),
+            castools.horzcat(*opt_p['_tvp', :]),
+            castools.horzcat(*opt_p['_y_meas', :]),
+            _p, opt_x['_p_est'], opt_p['_p_set'],
+        )
 
+        # Stack the constraints of each time step (column) and concatenate all time steps:
+        cons.append(castools.vec(castools.vertcat(g, cont, meas, nl_cons)))
+        # Bounds in the same order: Equality constraints (discretization, continuity, measurements) and nonlinear constraints.
+        n_eq_cons = g.shape[0] + n_x + self.model.n_y
+        step_cons_lb = np.concatenate([np.zeros(n_eq_cons), np.tile(self._nl_cons_lb.cat.full().ravel(), len(nl_cons_k))])
+        step_cons_ub = np.concatenate([np.zeros(n_eq_cons), np.tile(self._nl_cons_ub.cat.full().ravel(), len(nl_cons_k))])
+        cons_lb.append(np.tile(step_cons_lb, n_horizon).reshape(-1, 1))
+        cons_ub.append(np.tile(step_cons_ub, n_horizon).reshape(-1, 1))
 
-            # Calculate the auxiliary expressions for the current scenario:
-            opt_aux['_aux', k] = self.model._aux_expression_fun(
-                opt_x_unscaled['_x', k, -1], opt_x_unscaled['_u', k], opt_x_unscaled['_z', k, -1], opt_p['_tvp', k], _p)
+        obj += castools.sum2(stage_eps_cost)
 
-        self._update_bounds()
+        # Calculate the auxiliary expressions for all time steps:
+        opt_aux['_aux', :] = castools.horzsplit(aux)
 
         # Write all created elements to self:
         self._nlp_obj = obj
@@ -1205,27 +1418,56 @@ class MHE(Optimizer, Estimator):
         self._nlp_cons_ub = castools.vertcat(*self._nlp_cons_ub)
 
         # Validity check:
-        _test_obj_fun = castools.Function('f', [self._opt_x, self._opt_p], [self._nlp_obj])
-        _test_cons_fun = castools.Function('f', [self._opt_x, self._opt_p], [self._nlp_cons])
-        try:
-            _test_obj_fun(self.opt_x_num,self.opt_p_num)
-        except:
-            err_msg = 'The MHE optimization problem objective function contains unknown symbolic variables.'
-            raise Exception(err_msg)
-        try:
-            _test_cons_fun(self.opt_x_num,self.opt_p_num)
-        except:
-            err_msg = 'The MHE optimization problem constraint function contains unknown symbolic variables.'
-            raise Exception(err_msg)
+        if self.settings.validate_nlp_symbols:
+            _test_obj_fun = castools.Function('f', [self._opt_x, self._opt_p], [self._nlp_obj])
+            _test_cons_fun = castools.Function('f', [self._opt_x, self._opt_p], [self._nlp_cons])
+            try:
+                _test_obj_fun(self.opt_x_num,self.opt_p_num)
+            except:
+                err_msg = 'The MHE optimization problem objective function contains unknown symbolic variables.'
+                raise Exception(err_msg)
+            try:
+                _test_cons_fun(self.opt_x_num,self.opt_p_num)
+            except:
+                err_msg = 'The MHE optimization problem constraint function contains unknown symbolic variables.'
+                raise Exception(err_msg)
 
         self.n_opt_lagr = self._nlp_cons.shape[0]
         # Create casadi optimization object:
         nlpsol_opts = {
-            'expand': False,
-            'ipopt.linear_solver': 'mumps',
-        }.update(self.settings.nlpsol_opts)
+            'expand': self.settings.expand_nlp,
+            'ipopt.linear_solver': self.settings.linear_solver,
+        }
+        if self.settings.warm_start:
+            # Initialize IPOPT close to the previous solution (the multipliers are passed in Optimizer.solve):
+            nlpsol_opts.update({
+                'ipopt.warm_start_init_point': 'yes',
+                'ipopt.warm_start_bound_push': 1e-8,
+                'ipopt.warm_start_bound_frac': 1e-8,
+                'ipopt.warm_start_slack_bound_push': 1e-8,
+                'ipopt.warm_start_slack_bound_frac': 1e-8,
+                'ipopt.warm_start_mult_bound_push': 1e-8,
+                'ipopt.mu_strategy': 'adaptive',
+            })
+        if self.settings.jit_backend == 'aot':
+            # Compile the functions of the NLP (objective, constraints and their derivatives) to C code:
+            nlpsol_opts.update(self._get_jit_opts())
+            nlpsol_opts.update({'jit_cleanup': True})
+        # User supplied options take precedence:
+        nlpsol_opts.update(self.settings.nlpsol_opts)
+
         self.nlp = {'x': castools.vertcat(self._opt_x), 'f': self._nlp_obj, 'g': self._nlp_cons, 'p': castools.vertcat(self._opt_p)}
-        self.S = castools.nlpsol('S', 'ipopt', self.nlp, self.settings.nlpsol_opts)
+        if nlpsol_opts['expand'] and self.model.symvar_type == 'MX':
+            nlp_fun = castools.Function('nlp', [self.nlp['x'], self.nlp['p']], [self.nlp['f'], self.nlp['g']])
+            try:
+                nlp_fun.expand()
+            except RuntimeError as e:
+                # Not all MX expressions (e.g. external functions) can be expanded to SX.
+                warnings.warn('The MHE optimization problem could not be expanded and is created with MX expressions instead. Reason:\n{}'.format(e))
+                nlpsol_opts['expand'] = False
+        self.S = castools.nlpsol('S', 'ipopt', self.nlp, nlpsol_opts)
+        # Keep the options of the solver (e.g. for compile_nlp):
+        self._nlpsol_opts = nlpsol_opts
 
         # Create function to caculate all auxiliary expressions:
         self.opt_aux_expression_fun = castools.Function('opt_aux_expression_fun', [self._opt_x, self._opt_p], [self._opt_aux])
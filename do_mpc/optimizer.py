@@ -79,6 +79,9 @@ class Optimizer:
         ]
         self.slack_cost = 0
 
+        # Options passed to nlpsol when the NLP is created (if different from settings.nlpsol_opts):
+        self._nlpsol_opts = None
+
     @property
     def nlp_obj(self):
         """Query and modify (symbolically) the NLP objective function.
@@ -725,7 +728,10 @@ class Optimizer:
             subprocess.Popen(compiler_command, shell=True).wait()
 
         # Overwrite solver object with loaded nlp:
-        self.S = nlpsol('solver_compiled', 'ipopt', libname, self.settings.nlpsol_opts)
+        nlpsol_opts = self.settings.nlpsol_opts if self._nlpsol_opts is None else self._nlpsol_opts
+        # The compiled NLP is neither expanded nor compiled again:
+        nlpsol_opts = {key: val for key, val in nlpsol_opts.items() if key not in ('expand', 'compiler') and not key.startswith('jit')}
+        self.S = castools.nlpsol('solver_compiled', 'ipopt', libname, nlpsol_opts)
         print('Using compiled NLP solver.')
 
     def solve(self)->None:
@@ -146,6 +146,141 @@ class TestOscillatingMassesDiscrete(unittest.TestCase):
             raise Exception()
 
 
+    def test_mhe_SX(self):
+        print('Testing MHE with SX implementation')
+        model = self.template_model.template_model('SX')
+        self.oscillating_masses_discrete_mhe(model)
+
+    def test_mhe_MX(self):
+        print('Testing MHE with MX implementation')
+        model = self.template_model.template_model('MX')
+        self.oscillating_masses_discrete_mhe(model)
+
+    def test_mhe_settings(self):
+        print('Testing MHE with multiple threads, warm start and without NLP symbol validation')
+        # Threads are only used for MX models without expansion of the NLP:
+        model = self.template_model.template_model('MX')
+        # Warm starting changes the iterates of the solver (but not the solution):
+        self.oscillating_masses_discrete_mhe(model, tol=1e-6, n_threads=2, expand_nlp=False, warm_start=True, validate_nlp_symbols=False)
+
+    def test_mhe_meas_from_data(self):
+        print('Testing MHE with default measurement function')
+        model = self.template_model.template_model('SX')
+        simulator = self.template_simulator.template_simulator(model)
+        mhe = self.get_mhe(model, meas_from_data=True)
+        mhe.setup()
+
+        np.random.seed(99)
+
+        simulator.x0 = np.random.rand(model.n_x)-0.5
+        mhe.x0 = np.zeros(model.n_x)
+
+        simulator.set_initial_guess()
+        mhe.set_initial_guess()
+
+        n_horizon = mhe.settings.n_horizon
+        for k in range(8):
+            u0 = np.array([[0.5*np.sin(k)]])
+            y_next = simulator.make_step(u0)
+            mhe.make_step(y_next)
+
+            # Most recent measurements in chronological order. If less than n_horizon measurements are available,
+            # the oldest measurement is repeated:
+            y_hist = mhe.data._y
+            n_steps = min(y_hist.shape[0], n_horizon)
+            y_expected = np.concatenate([np.repeat(y_hist[-n_steps:-n_steps+1], n_horizon-n_steps, axis=0), y_hist[-n_steps:]])
+            y_meas = horzcat(*mhe.opt_p_num['_y_meas']).full().T
+
+            max_diff = np.max(np.abs(y_meas - y_expected))
+            self.assertTrue(max_diff == 0, 'Measurements for MHE differ from data at step {}. Max diff is {:.4E}.'.format(k, max_diff))
+
+    def get_mhe(self, model, **settings):
+        """
+        Configure MHE with scaling, bounds and soft constraints for the discrete DAE model.
+        """
+        mhe = do_mpc.estimator.MHE(model)
+
+        mhe.settings.n_horizon = 5
+        mhe.settings.t_step = 0.5
+        mhe.settings.supress_ipopt_output()
+        for key, value in settings.items():
+            setattr(mhe.settings, key, value)
+
+        mhe.set_default_objective(P_x=np.eye(4), P_v=10*np.eye(4))
+
+        mhe.scaling['_x', 'x'] = 2
+        mhe.scaling['_z', 'x_next'] = 2
+
+        mhe.bounds['lower', '_u', 'u'] = -1
+        mhe.bounds['upper', '_u', 'u'] = 1
+
+        mhe.set_nl_cons('x_0', model.x['x', 0], ub=-0.2, soft_constraint=True, penalty_term_cons=1e-1)
+
+        return mhe
+
+    def oscillating_masses_discrete_mhe(self, model, tol=1e-8, **settings):
+        """
+        Get configured do-mpc modules:
+        """
+        simulator = self.template_simulator.template_simulator(model)
+        mhe = self.get_mhe(model, **settings)
+
+        y_template = mhe.get_y_template()
+
+        def y_fun(t_now):
+            n_steps = min(mhe.data._y.shape[0], mhe.settings.n_horizon)
+            for k in range(-n_steps, 0):
+                y_template['y_meas', k] = mhe.data._y[k]
+            return y_template
+
+        mhe.set_y_fun(y_fun)
+        mhe.setup()
+
+        """
+        Set initial state
+        """
+        np.random.seed(99)
+
+        # Use different initial state for the true system (simulator) and for MHE
+        simulator.x0 = np.random.rand(model.n_x)-0.5
+        mhe.x0 = np.zeros(model.n_x)
+
+        simulator.set_initial_guess()
+        mhe.set_initial_guess()
+
+        """
+        Run some steps:
+        """
+
+        for k in range(8):
+            u0 = np.array([[0.5*np.sin(k)]])
+            y_next = simulator.make_step(u0)
+            x0 = mhe.make_step(y_next)
+
+        """
+        Store results (from reference run):
+        """
+        # do_mpc.data.save_results([simulator, mhe], 'results_oscillatingMasses_dae_mhe', overwrite=True)
+
+        """
+        Compare results to reference run:
+        """
+        ref = do_mpc.data.load_results('./results/results_oscillatingMasses_dae_mhe.pkl')
+
+        test = ['_x', '_u', '_aux', '_time', '_z']
+
+        msg = 'Check if variable {var} for {module} is identical to previous runs: {check}. Max diff is {max_diff:.4E}.'
+        for test_i in test:
+            # Check Simulator
+            max_diff = np.max(np.abs(simulator.data.__dict__[test_i] - ref['simulator'].__dict__[test_i]), initial=0)
+            check = max_diff < 1e-8
+            self.assertTrue(check, msg.format(var=test_i, module='Simulator', check=check, max_diff=max_diff))
+
+            # Estimator
+            max_diff = np.max(np.abs(mhe.data.__dict__[test_i] - ref['estimator'].__dict__[test_i]), initial=0)
+            check = max_diff < tol
+            self.assertTrue(check, msg.format(var=test_i, module='Estimator', check=check, max_diff=max_diff))
+
 
 if __name__ == '__main__':
     unittest.main()